@@ -1,23 +1,40 @@
-from flask import Flask, render_template, request, redirect, session, jsonify, make_response
+# Monkey-patch the standard library before anything else imports it so blocking I/O
+# (requests, sockets, threading) cooperates with the eventlet hub used by Flask-SocketIO
+import eventlet
+eventlet.monkey_patch()
+
+from flask import Flask, render_template, request, redirect, session, jsonify, g
+from flask.json.provider import DefaultJSONProvider
+from jinja2 import FileSystemBytecodeCache
 from kiteconnect import KiteConnect, KiteTicker
 from dotenv import load_dotenv
 import os
+import sys
 import logging
 from flask_socketio import SocketIO, emit
 import threading
 import time
+import queue
+import atexit
 from functools import wraps
-import json
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+import orjson
 import upstox_service  # Import the new Upstox service
 import asyncio  # For running async websocket code
 import requests
-from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
+import numpy as np
 
 # Ensure logs directory exists
 log_dir = os.path.join(os.getcwd(), "logs")
 os.makedirs(log_dir, exist_ok=True)
 log_file_path = os.path.join(log_dir, "pyalgo.log")
 
+# Ensure Jinja bytecode cache directory exists (compiled templates are shared across workers)
+jinja_cache_dir = os.path.join(os.getcwd(), ".jinja_cache")
+os.makedirs(jinja_cache_dir, exist_ok=True)
+
 # Configure THIS module's logger
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -42,9 +59,39 @@ else:
 
 load_dotenv()
 
+class OrjsonJSONProvider(DefaultJSONProvider):
+    """
+    JSON provider backed by orjson, so jsonify responses with large candle and quote
+    payloads serialize in C. Keys are sorted like Flask's default provider (sort_keys),
+    and values orjson can't handle natively (and datetimes, to keep Flask's HTTP date
+    format) fall back to DefaultJSONProvider.default.
+    """
+    option = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_PASSTHROUGH_DATETIME
+
+    def dumps(self, obj, **kwargs):
+        option = self.option
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2  # Pretty-printed responses in debug mode
+        return orjson.dumps(obj, default=DefaultJSONProvider.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonJSONProvider(app)
 app.secret_key = os.getenv('APP_SECRET_KEY')
-socketio = SocketIO(app)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(jinja_cache_dir)
+socketio = SocketIO(app, async_mode='eventlet', transports=['websocket'])  # Client connects websocket-only
+
+# Shared HTTP session for direct Upstox REST calls so TCP/TLS connections are pooled and reused
+UPSTOX_HTTP = requests.Session()
+UPSTOX_HTTP.mount('https://', HTTPAdapter(pool_connections=10, pool_maxsize=20))
+UPSTOX_HTTP_TIMEOUT = 5  # seconds
+
+# Worker pool for overlapping independent Upstox API calls made while serving a request
+upstox_request_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="upstox-request")
 
 # Kite API Configuration
 api_key = os.getenv('KITE_API_KEY')
@@ -57,18 +104,208 @@ instrument_map_by_token = {}
 WATCHLIST_DIR = os.path.join(os.getcwd(), "user_watchlists")
 os.makedirs(WATCHLIST_DIR, exist_ok=True)
 
+# Write-behind persistence for watchlist files: save_watchlist hands over the serialized
+# contents and watchlist_writer replaces the files on disk off the request thread
+watchlist_write_queue = queue.Queue()  # (path, bytes) pairs, drained by watchlist_writer
+watchlist_write_task = None
+watchlist_write_task_lock = threading.Lock()
+watchlist_pending_writes = {}  # path -> latest queued contents not yet on disk
+watchlist_write_errors = {}  # path -> error from the last failed write, reported by load_watchlist
+watchlist_pending_lock = threading.Lock()
+
 # Global variables for Upstox WebSocket
 upstox_ws_thread = None
 upstox_subscribed_instrument_keys = set()  # Stores keys like "NSE_EQ|INE002A01018"
 upstox_ws_shutdown_event = None # Will be a threading.Event
+upstox_ws_subscription_queue = None # Will be a queue.Queue of instrument key lists for the running thread
+upstox_ws_subscription_lock = threading.Lock()  # Guards the subscription queue/set against the WebSocket thread
+upstox_ws_unsent_instrument_keys = set()  # Keys a closed connection never sent; the next (re)start subscribes them
+upstox_ws_restart_lock = threading.RLock()  # Makes working out the key set and restarting the connection one step
+UPSTOX_WS_RESUBSCRIBE_DELAY = 5  # Seconds to wait before reconnecting to subscribe keys a closed connection never sent
+
+# Global watchlist LTPC store, laid out column-wise: one row per instrument_key,
+# one typed array per field so a tick is a scalar store and a snapshot is a slice
+LTPC_INITIAL_CAPACITY = 256
+LTPC_EMIT_BATCH_SIZE = 200  # Max LTPC updates per 'ltpc_update_batch' Socket.IO event
+LTPC_EMIT_WINDOW = 0.02  # Seconds to coalesce feed messages into one emit
+ltpc_emit_queue = queue.Queue(maxsize=1024)  # LTPC dicts from the feed, drained by ltpc_emit_worker
+ltpc_emit_task = None
+ltpc_emit_task_lock = threading.Lock()
+ltpc_lock = threading.Lock()
+ltpc_row_by_key = {}  # instrument_key -> row index into the arrays below
+ltpc_ltp = np.zeros(LTPC_INITIAL_CAPACITY, dtype=np.float64)
+ltpc_change = np.zeros(LTPC_INITIAL_CAPACITY, dtype=np.float64)
+ltpc_chp = np.zeros(LTPC_INITIAL_CAPACITY, dtype=np.float64)
+ltpc_ltt = np.zeros(LTPC_INITIAL_CAPACITY, dtype=np.int64)
+
+def update_watchlist_ltpc(ltpc_data):
+    """
+    Store the latest LTPC values for each instrument in the column-wise watchlist store.
+
+    Args:
+        ltpc_data (dict): instrument_key -> LTPC dict as returned by upstox_service.extract_ltpc_from_feed
+    """
+    global ltpc_ltp, ltpc_change, ltpc_chp, ltpc_ltt
+
+    with ltpc_lock:
+        for instrument_key, data in ltpc_data.items():
+            row = ltpc_row_by_key.get(instrument_key)
+            if row is None:
+                row = len(ltpc_row_by_key)
+                if row >= len(ltpc_ltp):
+                    # Grow all columns together, doubling capacity
+                    capacity = len(ltpc_ltp) * 2
+                    ltpc_ltp = np.resize(ltpc_ltp, capacity)
+                    ltpc_change = np.resize(ltpc_change, capacity)
+                    ltpc_chp = np.resize(ltpc_chp, capacity)
+                    ltpc_ltt = np.resize(ltpc_ltt, capacity)
+                ltpc_row_by_key[instrument_key] = row
+
+            ltpc_ltp[row] = data.get('ltp') or 0.0
+            ltpc_change[row] = data.get('change') or 0.0
+            ltpc_chp[row] = data.get('percentage_change') or 0.0
+            ltpc_ltt[row] = data.get('last_trade_time') or 0
+
+def get_watchlist_ltpc_snapshot():
+    """
+    Return a consistent snapshot of the watchlist LTPC store as plain lists, one per column.
+    """
+    with ltpc_lock:
+        n = len(ltpc_row_by_key)
+        return {
+            "instrument_keys": list(ltpc_row_by_key),
+            "ltp": ltpc_ltp[:n].tolist(),
+            "change": ltpc_change[:n].tolist(),
+            "percentage_change": ltpc_chp[:n].tolist(),
+            "last_trade_time": ltpc_ltt[:n].tolist()
+        }
 
-# Global variable to store watchlist LTPC updates
-watchlist_ltpc_data = {}
+# tradingsymbol -> instrument lookup, rebuilt only when upstox_service hands back a different cache list
+_symbol_index = {"source": None, "map": {}}
+
+def get_symbol_to_instrument(exchange="NSE_EQ"):
+    """
+    Return a tradingsymbol -> instrument dict for the exchange's instruments cache.
+    The dict is memoized and rebuilt only when the underlying cache list is reloaded.
+    """
+    instruments_cache = upstox_service.get_instruments_cache(exchange)
+    if instruments_cache is not _symbol_index["source"]:
+        _symbol_index["map"] = {
+            sys.intern(instrument['tradingsymbol']): instrument
+            for instrument in instruments_cache or ()
+            if instrument.get('tradingsymbol')
+        }
+        _symbol_index["source"] = instruments_cache
+        logger.debug(f"Created symbol lookup from {len(_symbol_index['map'])} instruments")
+    return _symbol_index["map"]
+
+def flatten_quote(quote):
+    """
+    Flatten a full market quote (as returned by upstox_service.get_full_market_quote_v2)
+    into the flat field set used by watchlist items.
+
+    Args:
+        quote (dict): Full market quote for a single instrument
+
+    Returns:
+        dict: Flat market data fields to merge into a watchlist item
+    """
+    ohlc = quote.get('ohlc') or {}
+    depth = quote.get('depth') or {}
+    buy = depth.get('buy')
+    sell = depth.get('sell')
+    last_price = quote.get('last_price')
+    return {
+        "ltp": last_price,
+        "last_price": last_price,
+        "open": ohlc.get('open'),
+        "high": ohlc.get('high'),
+        "low": ohlc.get('low'),
+        "close": ohlc.get('close'),
+        "change": quote.get('change', quote.get('net_change')),
+        "percentage_change": quote.get('change_percent', quote.get('net_change_percentage')),
+        "volume": quote.get('volume'),
+        "last_trade_time": quote.get('last_trade_time'),
+        "bid": buy[0].get('price') if buy else None,
+        "ask": sell[0].get('price') if sell else None,
+        "total_buy_qty": quote.get('total_buy_quantity', quote.get('total_buy_qty')),
+        "total_sell_qty": quote.get('total_sell_quantity', quote.get('total_sell_qty'))
+    }
 
 def get_watchlist_filepath(user_id=None):
     # Use a shared watchlist file instead of user-specific ones
     return os.path.join(WATCHLIST_DIR, "shared_watchlist.json")
 
+def write_file_atomic(path, data):
+    """Write bytes to a temporary file next to path and atomically move it into place."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def watchlist_writer():
+    """
+    Background task that persists queued watchlist files in order. A failed write keeps its
+    contents pending (still served by read_watchlist_file and retried at shutdown) and is
+    recorded in watchlist_write_errors until a later write of the same file succeeds.
+    """
+    while True:
+        path, data = watchlist_write_queue.get()
+        try:
+            write_file_atomic(path, data)
+        except Exception as e:
+            logger.error(f"Error writing watchlist file {path}: {e}", exc_info=True)
+            with watchlist_pending_lock:
+                watchlist_write_errors[path] = str(e)
+            continue
+        with watchlist_pending_lock:
+            watchlist_write_errors.pop(path, None)
+            # Only clear the entry if no newer contents were queued meanwhile
+            if watchlist_pending_writes.get(path) is data:
+                del watchlist_pending_writes[path]
+
+@atexit.register
+def flush_watchlist_writes():
+    """Write any watchlist contents still pending when the process exits."""
+    with watchlist_pending_lock:
+        pending = list(watchlist_pending_writes.items())
+    for path, data in pending:
+        try:
+            write_file_atomic(path, data)
+        except Exception as e:
+            logger.error(f"Error flushing watchlist file {path} at shutdown: {e}")
+
+def persist_watchlist_file(path, data):
+    """
+    Queue bytes to be written to path by the background writer.
+    Until the write lands, read_watchlist_file serves the queued contents.
+    """
+    global watchlist_write_task
+    with watchlist_pending_lock:
+        watchlist_pending_writes[path] = data
+    if watchlist_write_task is None:
+        with watchlist_write_task_lock:
+            if watchlist_write_task is None:
+                watchlist_write_task = socketio.start_background_task(watchlist_writer)
+    watchlist_write_queue.put((path, data))
+
+def read_watchlist_file(path):
+    """
+    Read a watchlist file, preferring contents still waiting to be persisted.
+
+    Returns:
+        bytes: File contents, or None if the file does not exist
+    """
+    with watchlist_pending_lock:
+        data = watchlist_pending_writes.get(path)
+    if data is not None:
+        return data
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
 # Middleware to check if the user is logged in
 def login_required(f):
     @wraps(f)
@@ -82,6 +319,18 @@ def login_required(f):
 kws_ticker = None
 dashboard_ws_thread = None
 subscribed_tokens = set()
+KITE_WS_MONITOR_INTERVAL = 5  # Seconds between connection checks while the Kite WebSocket task waits
+
+# Endpoints rendering per-user pages that must never be served from a browser or proxy cache
+NO_CACHE_ENDPOINTS = frozenset({'dashboard', 'user_profile'})
+
+@app.after_request
+def add_no_cache_headers(response):
+    if request.endpoint in NO_CACHE_ENDPOINTS:
+        response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+        response.headers['Pragma'] = 'no-cache' # For HTTP/1.0 proxies
+        response.headers['Expires'] = '0' # For proxies
+    return response
 
 def get_kite_instance():
     access_token = get_access_token()
@@ -94,6 +343,17 @@ def get_kite_instance():
 def get_access_token():
     return session.get('kite_access_token')
 
+def get_upstox_api_client():
+    """
+    Return the Upstox ApiClient for the current request, creating it on first use
+    and reusing it for the rest of the request via flask.g.
+    """
+    api_client = getattr(g, 'upstox_api_client', None)
+    if api_client is None:
+        api_client = upstox_service.get_configuration_api_client()
+        g.upstox_api_client = api_client
+    return api_client
+
 def require_login(f):
     """
     Decorator to ensure user is logged in before accessing protected routes
@@ -112,6 +372,9 @@ def require_login(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# Fields checked for every row of the Kite NSE instrument dump, fetched in one C-level call
+instrument_filter_fields = itemgetter('instrument_type', 'exchange', 'tradingsymbol', 'instrument_token', 'name')
+
 def ensure_instruments_cached(kite):
     global instrument_map_by_symbol, instrument_map_by_token
     if not instrument_map_by_symbol:
@@ -121,17 +384,14 @@ def ensure_instruments_cached(kite):
             temp_map_by_symbol = {}
             temp_map_by_token = {}
             for inst in all_nse_instruments:
-                if inst.get('instrument_type') == 'EQ' and \
-                   inst.get('exchange') == 'NSE' and \
-                   inst.get('tradingsymbol') and \
-                   inst.get('instrument_token') is not None and \
-                   inst.get('name'):
-                    temp_map_by_symbol[inst['tradingsymbol']] = inst
+                inst_type, exchange, tradingsymbol, instrument_token, name = instrument_filter_fields(inst)
+                if inst_type == 'EQ' and exchange == 'NSE' and tradingsymbol and instrument_token is not None and name:
+                    temp_map_by_symbol[tradingsymbol] = inst
                     try:
-                        token_key = int(inst['instrument_token'])
+                        token_key = int(instrument_token)
                         temp_map_by_token[token_key] = inst
                     except ValueError:
-                        logger.warning(f"Could not convert instrument token {inst['instrument_token']} to int for {inst['tradingsymbol']}")
+                        logger.warning(f"Could not convert instrument token {instrument_token} to int for {tradingsymbol}")
             instrument_map_by_symbol = temp_map_by_symbol
             instrument_map_by_token = temp_map_by_token
             logger.info(f"Fetched and cached {len(instrument_map_by_symbol)} NSE EQ instruments.")
@@ -144,9 +404,11 @@ def kite_websocket_task(access_token_ws, public_token_ws, symbols_to_subscribe_t
     logger.info(f"Kite WebSocket task starting for tokens: {symbols_to_subscribe_tokens}")
 
     kws_ticker = KiteTicker(api_key, access_token_ws)
+    disconnect_event = threading.Event()  # Set by on_close/on_error/on_noreconnect to end the task
+    connected_event = threading.Event()  # Set once on_connect has fired
 
     def on_ticks(ws, ticks):
-        logger.debug(f"Ticks received: {ticks}")
+        logger.debug("Ticks received: %s", ticks)
         socketio.emit('dashboard_chart_data', ticks)
 
     def on_order_update(ws, order):
@@ -155,6 +417,7 @@ def kite_websocket_task(access_token_ws, public_token_ws, symbols_to_subscribe_t
 
     def on_connect(ws, response):
         logger.info("Kite WS Connection Opened.")
+        connected_event.set()
         if ws:
             ws.subscribe(symbols_to_subscribe_tokens)
             ws.set_mode(ws.MODE_FULL, symbols_to_subscribe_tokens)
@@ -165,17 +428,24 @@ def kite_websocket_task(access_token_ws, public_token_ws, symbols_to_subscribe_t
         logger.info(f"Kite WS Closed: {code} - {reason}")
         socketio.emit('dashboard_chart_data', {'status': 'WebSocket closed', 'reason': reason})
         socketio.emit('kite_order_update', {'status': 'Order Update WebSocket closed', 'reason': reason})
+        disconnect_event.set()
 
     def on_error(ws, code, reason):
         logger.error(f"Kite WS Error: {code} - {reason}")
         socketio.emit('dashboard_chart_data', {'error': f'WebSocket error: {reason}'})
         socketio.emit('kite_order_update', {'error': f'Order Update WebSocket error: {reason}'})
+        disconnect_event.set()
+
+    def on_noreconnect(ws):
+        logger.error("Kite WS gave up reconnecting.")
+        disconnect_event.set()
 
     kws_ticker.on_ticks = on_ticks
     kws_ticker.on_connect = on_connect
     kws_ticker.on_close = on_close
     kws_ticker.on_error = on_error
     kws_ticker.on_order_update = on_order_update
+    kws_ticker.on_noreconnect = on_noreconnect
 
     if kws_ticker:
         kws_ticker.connect(threaded=True, disable_ssl_verification=False)
@@ -184,8 +454,12 @@ def kite_websocket_task(access_token_ws, public_token_ws, symbols_to_subscribe_t
         return
 
     try:
-        while kws_ticker and kws_ticker.is_connected():
-            time.sleep(1)
+        # Wake as soon as the ticker reports a close or error, and check the connection
+        # periodically so a missed callback can't park this task forever
+        while not disconnect_event.wait(timeout=KITE_WS_MONITOR_INTERVAL):
+            if connected_event.is_set() and not kws_ticker.is_connected():
+                logger.warning("Kite WS is no longer connected but no close/error callback fired.")
+                break
     except Exception as e:
         logger.error(f"Exception in kite_websocket_task monitoring loop: {e}")
     finally:
@@ -208,8 +482,13 @@ def process_upstox_feed(feed_response, emit_callback):
             if feed_data.ff.marketFF.ltpc:
                 ltpc = feed_data.ff.marketFF.ltpc
                 tick["last_price"] = ltpc.ltp
-                tick["change"] = ltpc.ch if ltpc.ch is not None else (ltpc.ltp - ltpc.cp if ltpc.ltp and ltpc.cp else 0)
-                tick["percentage_change"] = ltpc.chp
+                # The v3 LTPC message carries only ltp/ltt/ltq/cp, so derive change from the previous close
+                if ltpc.ltp and ltpc.cp:
+                    tick["change"] = ltpc.ltp - ltpc.cp
+                    tick["percentage_change"] = tick["change"] / ltpc.cp * 100
+                else:
+                    tick["change"] = 0
+                    tick["percentage_change"] = 0
                 tick["last_traded_time"] = ltpc.ltt
                 if ltpc.ltt:
                     tick["timestamp"] = ltpc.ltt * 1000
@@ -228,18 +507,23 @@ def process_upstox_feed(feed_response, emit_callback):
     except Exception as e:
         logger.error(f"Error processing Upstox feed: {e}", exc_info=True)
 
-@socketio.on('subscribe_upstox_market_data')
-@require_login
-def handle_subscribe_upstox_market_data(data):
-    global upstox_ws_thread, upstox_subscribed_instrument_keys, upstox_ws_shutdown_event
+def start_upstox_market_data_stream(instrument_keys):
+    """
+    (Re)start the Upstox market data WebSocket thread for instrument_keys, stopping any
+    running connection first. Doesn't need a Socket.IO or request context, so it can also
+    be used from background tasks.
 
-    instrument_keys_to_subscribe = data.get('instrument_keys', [])
-    if not isinstance(instrument_keys_to_subscribe, list): # Added check for empty list as well
-        logger.warning("Invalid or empty instrument_keys for Upstox subscription.")
-        emit('upstox_market_data_error', {'error': 'Invalid or empty instrument keys provided.'})
-        return
+    Args:
+        instrument_keys (list): Full set of instrument keys to subscribe
 
-    logger.info(f"Request to subscribe/update Upstox market data for: {instrument_keys_to_subscribe}")
+    Returns:
+        tuple: (event, payload) describing the outcome, for the caller to emit or log
+    """
+    with upstox_ws_restart_lock:
+        return _start_upstox_market_data_stream(instrument_keys)
+
+def _start_upstox_market_data_stream(instrument_keys):
+    global upstox_ws_thread, upstox_subscribed_instrument_keys, upstox_ws_shutdown_event, upstox_ws_subscription_queue
 
     # --- Shutdown existing thread if running ---
     if upstox_ws_thread and upstox_ws_thread.is_alive():
@@ -256,39 +540,59 @@ def handle_subscribe_upstox_market_data(data):
     upstox_ws_shutdown_event = None # Clear or will be reset
 
     # Update current subscriptions to the new set
-    new_subscription_set = set(instrument_keys_to_subscribe)
-    upstox_subscribed_instrument_keys = new_subscription_set
+    new_subscription_set = set(instrument_keys)
+    with upstox_ws_subscription_lock:
+        upstox_ws_subscription_queue = None
+        upstox_subscribed_instrument_keys = new_subscription_set
+        upstox_ws_unsent_instrument_keys.clear()  # Superseded by the new set
 
     # If no instruments to subscribe to after update, ensure everything is stopped and return
-    if not upstox_subscribed_instrument_keys:
+    if not new_subscription_set:
         logger.info("No instruments to subscribe to for Upstox WebSocket. Connection will remain closed.")
         # upstox_ws_thread and upstox_ws_shutdown_event are already None or will be.
-        emit('upstox_market_data_status', {'status': 'No instruments for Upstox WebSocket subscription. Connection closed.'})
-        return
+        return 'upstox_market_data_status', {'status': 'No instruments for Upstox WebSocket subscription. Connection closed.'}
 
     # --- Proceed with new connection/subscription ---
     upstox_api_client = upstox_service.get_configuration_api_client()
     if not upstox_api_client:
         logger.error("Failed to get Upstox ApiClient for WebSocket.")
-        emit('upstox_market_data_error', {'error': 'Upstox authentication failed or ApiClient not available.'})
-        return
+        return 'upstox_market_data_error', {'error': 'Upstox authentication failed or ApiClient not available.'}
 
     feed_url = upstox_service.get_market_data_feed_authorize_url(upstox_api_client)
     logger.debug(f"Feed URL: {feed_url}")
     if not feed_url:
         logger.error("Failed to get Upstox market data feed URL.")
-        emit('upstox_market_data_error', {'error': 'Failed to get market data feed URL.'})
-        return
+        return 'upstox_market_data_error', {'error': 'Failed to get market data feed URL.'}
 
     # Callback for processing messages from the WebSocket service
     def on_upstox_message_socketio(feed_response):
         process_upstox_feed(feed_response, socketio.emit)
         on_upstox_market_data(feed_response) # For LTPC updates
 
-    logger.info(f"Starting new Upstox WebSocket thread for instruments: {list(upstox_subscribed_instrument_keys)}")
-
-    # Create a new threading.Event for the new thread
-    upstox_ws_shutdown_event = threading.Event()
+    logger.info(f"Starting new Upstox WebSocket thread for instruments: {list(new_subscription_set)}")
+
+    # Create a new threading.Event and subscription queue for the new thread
+    shutdown_event = threading.Event()
+    subscription_queue = queue.Queue()
+
+    def on_upstox_keys_subscribed(keys):
+        # Keys count as subscribed only once the connection has actually sent them
+        with upstox_ws_subscription_lock:
+            if subscription_queue is upstox_ws_subscription_queue:
+                upstox_subscribed_instrument_keys.update(keys)
+
+    def on_upstox_stream_closed(unsent_keys):
+        global upstox_ws_subscription_queue
+        with upstox_ws_subscription_lock:
+            if subscription_queue is not upstox_ws_subscription_queue:
+                return  # A newer connection has replaced this one
+            # Stop queueing onto this connection; later additions start a new one instead
+            upstox_ws_subscription_queue = None
+            unsent_keys = upstox_service.drain_subscription_queue(subscription_queue, list(unsent_keys))
+            upstox_ws_unsent_instrument_keys.update(unsent_keys)
+        if unsent_keys and not shutdown_event.is_set():
+            logger.warning(f"Upstox WebSocket closed before subscribing {unsent_keys}, resubscribing")
+            socketio.start_background_task(resubscribe_upstox_market_data)
 
     def run_websocket_loop_in_thread():
         loop = asyncio.new_event_loop()
@@ -296,9 +600,12 @@ def handle_subscribe_upstox_market_data(data):
         try:
             loop.run_until_complete(upstox_service.connect_and_stream_market_data(
                 feed_url,
-                list(upstox_subscribed_instrument_keys),
+                list(new_subscription_set),
                 on_upstox_message_socketio,
-                upstox_ws_shutdown_event  # Pass the threading.Event
+                shutdown_event,  # Pass the threading.Event
+                subscription_queue,
+                on_upstox_keys_subscribed,
+                on_upstox_stream_closed
             ))
         except Exception as e_thread:
             logger.error(f"Exception in Upstox WebSocket thread's event loop: {e_thread}", exc_info=True)
@@ -306,12 +613,68 @@ def handle_subscribe_upstox_market_data(data):
             loop.close()
             logger.info("Upstox WebSocket thread event loop and asyncio loop closed.")
 
+    upstox_ws_shutdown_event = shutdown_event
+    with upstox_ws_subscription_lock:
+        upstox_ws_subscription_queue = subscription_queue
     upstox_ws_thread = threading.Thread(target=run_websocket_loop_in_thread, daemon=True)
     upstox_ws_thread.start()
 
-    emit('upstox_market_data_status', {
-        'status': f'Subscribing to {list(upstox_subscribed_instrument_keys)} via Upstox WebSocket.'
-    })
+    return 'upstox_market_data_status', {
+        'status': f'Subscribing to {list(new_subscription_set)} via Upstox WebSocket.'
+    }
+
+def resubscribe_upstox_market_data():
+    """
+    Background task that subscribes the keys a closed Upstox connection never sent, after a
+    short delay. The key set is worked out only then, so subscriptions made in the meantime
+    aren't dropped.
+    """
+    socketio.sleep(UPSTOX_WS_RESUBSCRIBE_DELAY)
+    with upstox_ws_restart_lock:
+        with upstox_ws_subscription_lock:
+            if not upstox_ws_unsent_instrument_keys:
+                return  # A connection started since then already subscribed them
+            all_keys = list(upstox_subscribed_instrument_keys | upstox_ws_unsent_instrument_keys)
+        event, payload = start_upstox_market_data_stream(all_keys)
+    logger.info(f"Upstox WebSocket resubscribe: {payload}")
+
+@socketio.on('subscribe_upstox_market_data')
+@require_login
+def handle_subscribe_upstox_market_data(data):
+    instrument_keys_to_subscribe = data.get('instrument_keys', [])
+    if not isinstance(instrument_keys_to_subscribe, list): # Added check for empty list as well
+        logger.warning("Invalid or empty instrument_keys for Upstox subscription.")
+        emit('upstox_market_data_error', {'error': 'Invalid or empty instrument keys provided.'})
+        return
+
+    logger.info(f"Request to subscribe/update Upstox market data for: {instrument_keys_to_subscribe}")
+
+    event, payload = start_upstox_market_data_stream(instrument_keys_to_subscribe)
+    emit(event, payload)
+
+def add_upstox_market_data_subscriptions(instrument_keys):
+    """
+    Subscribe additional instruments on the running Upstox WebSocket without resubscribing
+    the existing ones. Starts a new connection if none is running.
+
+    Args:
+        instrument_keys (list): Instrument keys to add to the current subscription
+    """
+    with upstox_ws_restart_lock:
+        with upstox_ws_subscription_lock:
+            new_keys = set(instrument_keys) - upstox_subscribed_instrument_keys
+            if not new_keys:
+                return
+            if upstox_ws_subscription_queue is not None:
+                # The keys are recorded as subscribed by the WebSocket thread once it sends them;
+                # if the connection closes first they're handed back and resubscribed
+                upstox_ws_subscription_queue.put(list(new_keys))
+                logger.info(f"Queued incremental Upstox subscription for: {list(new_keys)}")
+                return
+            # Include keys a closed connection never sent so the new one doesn't leave them out
+            all_keys = list(upstox_subscribed_instrument_keys | upstox_ws_unsent_instrument_keys | new_keys)
+        event, payload = start_upstox_market_data_stream(all_keys)
+    logger.info(f"Upstox WebSocket subscription: {payload}")
 
 @socketio.on('unsubscribe_upstox_market_data')
 @require_login
@@ -326,15 +689,10 @@ def handle_unsubscribe_upstox_market_data(data):
 
     logger.info(f"Request to unsubscribe from Upstox market data for: {instrument_keys_to_unsubscribe}")
 
-    made_change = False
-    # Operate on a copy of the current subscriptions
-    current_subscriptions_set = set(list(upstox_subscribed_instrument_keys))
-    for key in instrument_keys_to_unsubscribe:
-        if key in current_subscriptions_set:
-            current_subscriptions_set.remove(key)
-            made_change = True
+    # New subscription set without the requested keys (the global set itself is left untouched)
+    current_subscriptions_set = upstox_subscribed_instrument_keys.difference(instrument_keys_to_unsubscribe)
 
-    if made_change:
+    if len(current_subscriptions_set) != len(upstox_subscribed_instrument_keys):
         logger.info(f"New Upstox subscription set after unsubscribe: {list(current_subscriptions_set)}")
         # Call the main subscription handler to reconnect with the new set (or close if empty)
         # This will handle stopping the old thread and starting a new one if needed.
@@ -359,7 +717,8 @@ def index():
     # Check if the Upstox token is expired and remove if needed
     if upstox_authenticated:
         token_expiry = session.get('upstox_token_expiry')
-        if token_expiry and datetime.fromisoformat(token_expiry) <= datetime.now():
+        # Expiry is stored as epoch seconds; a non-int value comes from an older session and is treated as expired
+        if token_expiry is not None and (not isinstance(token_expiry, int) or token_expiry <= time.time()):
             # Token is expired, mark as not authenticated
             session['upstox_authenticated'] = False
             upstox_authenticated = False
@@ -375,7 +734,7 @@ def index():
                         'Authorization': f'Bearer {session["upstox_access_token"]}'
                     }
                     profile_url = "https://api.upstox.com/v2/user/profile"
-                    profile_response = requests.get(profile_url, headers=headers)
+                    profile_response = UPSTOX_HTTP.get(profile_url, headers=headers, timeout=UPSTOX_HTTP_TIMEOUT)
                     profile_response.raise_for_status()
 
                     # Parse response according to Upstox API documentation
@@ -494,11 +853,7 @@ def dashboard():
         # dashboard.html would ideally be able to use profile (Kite) and/or upstox_profile
         upstox_profile = session.get('upstox_profile')
 
-        resp = make_response(render_template('dashboard.html', profile=profile, upstox_profile=upstox_profile))
-        resp.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-        resp.headers['Pragma'] = 'no-cache' # For HTTP/1.0 proxies
-        resp.headers['Expires'] = '0' # For proxies
-        return resp
+        return render_template('dashboard.html', profile=profile, upstox_profile=upstox_profile)
     except Exception as e:
         logger.error(f"Error accessing dashboard: {str(e)}")
         session.clear()  # Clear invalid session
@@ -523,11 +878,7 @@ def user_profile():
                 # The template should handle cases where profile data might be missing.
                 pass
 
-    resp = make_response(render_template('profile.html', profile=kite_profile_data, upstox_profile=upstox_profile_data))
-    resp.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-    resp.headers['Pragma'] = 'no-cache'
-    resp.headers['Expires'] = '0'
-    return resp
+    return render_template('profile.html', profile=kite_profile_data, upstox_profile=upstox_profile_data)
 
 @app.route('/logout')
 def logout():
@@ -546,12 +897,13 @@ def load_watchlist():
         #user_id = session.get('user_profile', {}).get('user_id', 'default_user')
 
         watchlist_path = get_watchlist_filepath()
+        is_upstox_auth = session.get('upstox_authenticated', False)
         watchlist_items = []
         instrument_keys = []
 
-        if os.path.exists(watchlist_path):
-            with open(watchlist_path, 'r') as f:
-                watchlist_data = json.load(f)
+        watchlist_bytes = read_watchlist_file(watchlist_path)
+        if watchlist_bytes is not None:
+            watchlist_data = orjson.loads(watchlist_bytes)
 
             # First pass: Create basic watchlist items and collect instrument_keys
             for item in watchlist_data:
@@ -604,7 +956,7 @@ def load_watchlist():
                 if instrument_key:
                     instrument_keys.append(instrument_key)
             # Only fetch market data if we have instrument keys and user is authenticated with Upstox
-            if instrument_keys and session.get('upstox_authenticated', False):
+            if instrument_keys and is_upstox_auth:
                 try:
                     # Fetch full market quote data for all instruments at once
                     market_data = upstox_service.get_full_market_quote_v2(instrument_keys=instrument_keys)
@@ -636,22 +988,7 @@ def load_watchlist():
 
                                 if quote:
                                     # Add market data to each watchlist item
-                                    item.update({
-                                        "ltp": quote.get('last_price'),
-                                        "last_price": quote.get('last_price'),
-                                        "open": quote.get('ohlc', {}).get('open'),
-                                        "high": quote.get('ohlc', {}).get('high'),
-                                        "low": quote.get('ohlc', {}).get('low'),
-                                        "close": quote.get('ohlc', {}).get('close'),
-                                        "change": quote.get('net_change'),  # Updated from 'change' to 'net_change'
-                                        "percentage_change": quote.get('change_percent', quote.get('net_change_percentage')),
-                                        "volume": quote.get('volume'),
-                                        "last_trade_time": quote.get('last_trade_time'),
-                                        "bid": quote.get('depth', {}).get('buy', [{}])[0].get('price') if quote.get('depth', {}).get('buy') else None,
-                                        "ask": quote.get('depth', {}).get('sell', [{}])[0].get('price') if quote.get('depth', {}).get('sell') else None,
-                                        "total_buy_qty": quote.get('total_buy_quantity', quote.get('total_buy_qty')),
-                                        "total_sell_qty": quote.get('total_sell_quantity', quote.get('total_sell_qty'))
-                                    })
+                                    item.update(flatten_quote(quote))
                                 else:
                                     logger.warning(f"No market data found for {item.get('tradingsymbol')} with key {instrument_key}")
                         logger.info(f"Enhanced watchlist with full market quote data for {len(market_data)} instruments")
@@ -661,10 +998,16 @@ def load_watchlist():
                     logger.error(f"Error fetching full market quote data: {e}")
                     # Continue with basic watchlist items without market data
             else:
-                logger.info(f"Skipping market data fetch: Found {len(instrument_keys)} instruments, Upstox auth: {session.get('upstox_authenticated', False)}")
+                logger.info(f"Skipping market data fetch: Found {len(instrument_keys)} instruments, Upstox auth: {is_upstox_auth}")
 
             logger.info(f"Loaded watchlist , real-time updates will be provided by market feed")
-            return jsonify({"success": True, "watchlist": watchlist_items})
+            response = {"success": True, "watchlist": watchlist_items}
+            with watchlist_pending_lock:
+                write_error = watchlist_write_errors.get(watchlist_path)
+            if write_error:
+                # The in-memory watchlist is served, but the last save never reached disk
+                response["warning"] = f"Latest watchlist changes could not be saved to disk: {write_error}"
+            return jsonify(response)
         else:
             logger.info(f"No existing watchlist found for user ")
             return jsonify({"success": True, "watchlist": []})
@@ -679,22 +1022,14 @@ def save_watchlist():
     """API endpoint to save a user's watchlist"""
     try:
         watchlist_data = request.json.get('watchlist', [])
+        is_upstox_auth = session.get('upstox_authenticated', False)
 
         # Use user_id from session or a default if not available
         #user_id = session.get('user_profile', {}).get('user_id', 'default_user')
         watchlist_path = get_watchlist_filepath()
 
-        # Get the instrument cache only once for efficiency
-        instruments_cache = upstox_service.get_instruments_cache("NSE_EQ")
-
-        # Create a lookup dictionary for faster access to instruments by tradingsymbol
-        symbol_to_instrument = {}
-        if instruments_cache:
-            for instrument in instruments_cache:
-                tradingsymbol = instrument.get('tradingsymbol')
-                if tradingsymbol:
-                    symbol_to_instrument[tradingsymbol] = instrument
-            logger.debug(f"Created symbol lookup from {len(symbol_to_instrument)} instruments")
+        # Lookup dictionary for faster access to instruments by tradingsymbol (memoized across requests)
+        symbol_to_instrument = get_symbol_to_instrument("NSE_EQ")
 
         # Helper function to get instrument key from tradingsymbol
         def get_instrument_key(tradingsymbol):
@@ -702,123 +1037,126 @@ def save_watchlist():
             if instrument and 'instrument_key' in instrument:
                 return instrument['instrument_key']
             logger.warning(f"Could not find instrument_key for {tradingsymbol} in instrument cache")
-            return f"NSE_EQ|{tradingsymbol}"  # Fallback format
-
-        # Helper function to process a watchlist item into standardized format
-        def process_item(item):
-            if isinstance(item, str):
-                # Simple string format - convert to dictionary with tradingsymbol
-                tradingsymbol = item
-                instrument = symbol_to_instrument.get(tradingsymbol)
+            return sys.intern(f"NSE_EQ|{tradingsymbol}")  # Fallback format, interned as it is reused as a set/dict key
 
-                processed_item = {"tradingsymbol": tradingsymbol}
-                if instrument:
-                    processed_item['name'] = instrument.get('name')
-                    processed_item['instrument_key'] = instrument.get('instrument_key')
+        # Helper functions to standardize string and dict watchlist items
+        def process_symbol_item(tradingsymbol):
+            # Simple string format - convert to dictionary with tradingsymbol
+            instrument = symbol_to_instrument.get(tradingsymbol)
+            if not instrument:
+                return {"tradingsymbol": tradingsymbol}
 
-                return processed_item
+            return {
+                "tradingsymbol": tradingsymbol,
+                "name": instrument.get('name'),
+                "instrument_key": instrument.get('instrument_key')
+            }
 
-            elif isinstance(item, dict):
-                # Dictionary format - ensure it has name and instrument_key if possible
-                processed_item = item.copy()  # Make a copy to avoid modifying the original
-                tradingsymbol = item.get('tradingsymbol')
+        def process_dict_item(item):
+            # Fast path: item is already in the saved format, nothing to fill in or strip
+            if 'instrument_key' in item and 'name' in item and 'symbol' not in item and 'description' not in item:
+                return item
 
-                if tradingsymbol and 'instrument_key' not in processed_item:
-                    instrument = symbol_to_instrument.get(tradingsymbol)
-                    if instrument:
-                        if 'name' not in processed_item:
-                            processed_item['name'] = instrument.get('name')
-                        processed_item['instrument_key'] = instrument.get('instrument_key')
+            # Dictionary format - ensure it has name and instrument_key if possible
+            processed_item = item.copy()  # Make a copy to avoid modifying the original
+            tradingsymbol = item.get('tradingsymbol')
 
+            if tradingsymbol and 'instrument_key' not in processed_item:
+                instrument = symbol_to_instrument.get(tradingsymbol)
+                if instrument:
+                    if 'name' not in processed_item:
+                        processed_item['name'] = instrument.get('name')
+                    processed_item['instrument_key'] = instrument.get('instrument_key')
 
-                # Remove any symbol/description fields to ensure we only use tradingsymbol/name
-                processed_item.pop('symbol', None)
-                processed_item.pop('description', None)
+            # Remove any symbol/description fields to ensure we only use tradingsymbol/name
+            processed_item.pop('symbol', None)
+            processed_item.pop('description', None)
 
-                return processed_item
+            return processed_item
 
-            # If we get here, it's an unsupported format
-            logger.warning(f"Skipping watchlist item with unexpected format: {item}")
-            return None
+        # Items decoded from request JSON are exactly str or dict, so one type lookup picks the handler
+        item_processors = {str: process_symbol_item, dict: process_dict_item}
 
-        # Get the previous watchlist to detect new items
+        # Helper function to process a watchlist item into standardized format
+        def process_item(item):
+            processor = item_processors.get(type(item))
+            if processor is None:
+                # Unsupported format
+                logger.warning(f"Skipping watchlist item with unexpected format: {item}")
+                return None
+            return processor(item)
+
+        # Get the previous watchlist's instrument keys to detect new items. The sidecar
+        # keys file written on every save avoids parsing the full watchlist JSON.
+        watchlist_keys_path = watchlist_path + '.keys'
         previous_watchlist = []
         previous_instrument_keys = set()
-        if os.path.exists(watchlist_path):
+        previous_keys_bytes = None
+        try:
+            previous_keys_bytes = read_watchlist_file(watchlist_keys_path)
+            if previous_keys_bytes is not None:
+                previous_instrument_keys = set(previous_keys_bytes.decode().splitlines())
+        except Exception as e:
+            logger.warning(f"Could not read previous watchlist keys: {e}")
+        if previous_keys_bytes is None:
             try:
-                with open(watchlist_path, 'r') as f:
-                    previous_watchlist = json.load(f)
-
-                # Extract instrument keys from previous watchlist
-                for item in previous_watchlist:
-                    if isinstance(item, str):
-                        previous_instrument_keys.add(get_instrument_key(item))
-                    elif isinstance(item, dict):
-                        if 'instrument_key' in item:
-                            previous_instrument_keys.add(item['instrument_key'])
-                        elif 'tradingsymbol' in item:
-                            previous_instrument_keys.add(get_instrument_key(item['tradingsymbol']))
+                previous_watchlist_bytes = read_watchlist_file(watchlist_path)
+                if previous_watchlist_bytes is not None:
+                    previous_watchlist = orjson.loads(previous_watchlist_bytes)
+
+                # Extract instrument keys from previous watchlist, only looking up the
+                # instrument cache for items that don't already carry an instrument_key
+                previous_instrument_keys = {
+                    get_instrument_key(item) if isinstance(item, str)
+                    else item.get('instrument_key') or (get_instrument_key(item['tradingsymbol']) if item.get('tradingsymbol') else None)
+                    for item in previous_watchlist
+                    if isinstance(item, (str, dict))
+                } - {None, ''}
             except Exception as e:
                 logger.warning(f"Could not read previous watchlist: {e}")
 
         # Process watchlist data before saving
-        processed_watchlist = []
-        new_instrument_keys = []
+        processed_watchlist = [processed_item for processed_item in map(process_item, watchlist_data) if processed_item]
+        new_instrument_keys = [item['instrument_key'] for item in processed_watchlist if 'instrument_key' in item]
 
-        for item in watchlist_data:
-            processed_item = process_item(item)
-            if processed_item:
-                processed_watchlist.append(processed_item)
-                if 'instrument_key' in processed_item:
-                    new_instrument_keys.append(processed_item['instrument_key'])
+        # Save the processed watchlist; the files are written by the background writer
+        persist_watchlist_file(watchlist_path, orjson.dumps(processed_watchlist))
+        persist_watchlist_file(watchlist_keys_path, "\n".join(key for key in new_instrument_keys if key).encode())
 
-        # Save the processed watchlist
-        with open(watchlist_path, 'w') as f:
-            json.dump(processed_watchlist, f)
-
-        logger.info(f"Processed and saved watchlist with {len(processed_watchlist)} items")
+        logger.info(f"Processed and queued save of watchlist with {len(processed_watchlist)} items")
 
         # Find items that weren't in the previous watchlist
         new_added_items = [key for key in new_instrument_keys if key and key not in previous_instrument_keys]
 
         # If there are new items and the user is authenticated with Upstox,
         # fetch initial quote data and subscribe to market data feed
-        if new_added_items and session.get('upstox_authenticated', False):
+        if new_added_items and is_upstox_auth:
             try:
-                # 1. Fetch initial quote data for the new items
-                initial_data = upstox_service.get_full_market_quote_v2(instrument_keys=new_added_items)
+                # 1. Start fetching initial quote data for the new items in the background
+                quote_future = upstox_request_executor.submit(
+                    upstox_service.get_full_market_quote_v2, instrument_keys=new_added_items
+                )
+
+                # 2. Subscribe the new items on the market data feed while the quote request is in flight
+                # (kept on the request thread since the fallback path needs the request/session context)
+                try:
+                    add_upstox_market_data_subscriptions(new_added_items)
+                except Exception as e:
+                    logger.error(f"Error subscribing new watchlist items to market data: {e}", exc_info=True)
+
+                # 3. Apply the initial quote data once it arrives
+                initial_data = quote_future.result()
                 if initial_data:
                     logger.info(f"Fetched initial market data for {len(initial_data)} newly added watchlist items")
 
-                    # Update the processed watchlist items with the market data
-                    for item in processed_watchlist:
-                        if 'instrument_key' in item and item['instrument_key'] in initial_data:
-                            quote = initial_data[item['instrument_key']]
-                            # Update the item with market data
-                            item.update({
-                                "ltp": quote.get('last_price'),
-                                "last_price": quote.get('last_price'),
-                                "open": quote.get('ohlc', {}).get('open'),
-                                "high": quote.get('ohlc', {}).get('high'),
-                                "low": quote.get('ohlc', {}).get('low'),
-                                "close": quote.get('ohlc', {}).get('close'),
-                                "change": quote.get('change', quote.get('net_change')),
-                                "percentage_change": quote.get('change_percent', quote.get('net_change_percentage')),
-                                "volume": quote.get('volume'),
-                                "last_trade_time": quote.get('last_trade_time'),
-                                "bid": quote.get('depth', {}).get('buy', [{}])[0].get('price') if quote.get('depth', {}).get('buy') else None,
-                                "ask": quote.get('depth', {}).get('sell', [{}])[0].get('price') if quote.get('depth', {}).get('sell') else None,
-                                "total_buy_qty": quote.get('total_buy_quantity', quote.get('total_buy_qty')),
-                                "total_sell_qty": quote.get('total_sell_quantity', quote.get('total_sell_qty'))
-                            })
+                    # Update the processed watchlist items with the market data, walking only the
+                    # (few) returned quotes and finding their items through a key index
+                    items_by_key = {item['instrument_key']: item for item in processed_watchlist if 'instrument_key' in item}
+                    for instrument_key, quote in initial_data.items():
+                        item = items_by_key.get(instrument_key)
+                        if item:
+                            item.update(flatten_quote(quote))
                             logger.info(f"Updated watchlist item {item.get('tradingsymbol')} with market data")
-
-                # 2. Update the subscription for market data feed to include the new items
-                global upstox_subscribed_instrument_keys
-                updated_instruments = set(upstox_subscribed_instrument_keys).union(new_added_items)
-                if updated_instruments != upstox_subscribed_instrument_keys:
-                    logger.info(f"Updating market data subscription to include new watchlist items")
-                    handle_subscribe_upstox_market_data({'instrument_keys': list(updated_instruments)})
             except Exception as e:
                 logger.error(f"Error initializing market data for new watchlist items: {e}", exc_info=True)
                 # Don't fail if we can't fetch initial market data, the watchlist is still saved
@@ -842,7 +1180,7 @@ def search_upstox_symbols():
             return jsonify({"success": True, "symbols": []})
 
         # Get Upstox client
-        upstox_api_client = upstox_service.get_configuration_api_client()
+        upstox_api_client = get_upstox_api_client()
         if not upstox_api_client:
             logger.error("Failed to get Upstox ApiClient for symbol search.")
             return jsonify({"success": False, "error": "Upstox authentication failed"}), 401
@@ -903,11 +1241,6 @@ def login_upstox():
 def upstox_callback():
     """Handle callback from Upstox OAuth flow as per official documentation"""
     try:
-        # Save Zerodha (Kite) authentication data if it exists
-        kite_access_token = session.get('kite_access_token')
-        kite_public_token = session.get('kite_public_token')
-        user_profile = session.get('user_profile')
-
         # Get the authorization code from the request
         auth_code = request.args.get('code')
         if not auth_code:
@@ -928,7 +1261,7 @@ def upstox_callback():
             "grant_type": "authorization_code"
         }
 
-        response = requests.post(token_url, data=token_data)
+        response = UPSTOX_HTTP.post(token_url, data=token_data, timeout=UPSTOX_HTTP_TIMEOUT)
         response.raise_for_status()
 
         token_response = response.json()
@@ -942,18 +1275,13 @@ def upstox_callback():
             logger.error("No access token received from Upstox")
             return render_template('layout.html', error="Failed to obtain access token from Upstox.")
 
-        # Calculate expiry time
-        expiry_time = datetime.now() + timedelta(seconds=expires_in)
-
-        # Store tokens in session while preserving Kite data
-        if kite_access_token:
-            session['kite_access_token'] = kite_access_token
-            session['kite_public_token'] = kite_public_token
-            session['user_profile'] = user_profile
+        # Calculate expiry time as epoch seconds
+        expiry_time = int(time.time() + expires_in)
 
+        # Store tokens in session
         session['upstox_access_token'] = access_token
         session['upstox_refresh_token'] = refresh_token
-        session['upstox_token_expiry'] = expiry_time.isoformat()
+        session['upstox_token_expiry'] = expiry_time
         session['upstox_authenticated'] = True
 
         # Use the upstox_service function to save token in memory only
@@ -970,7 +1298,7 @@ def upstox_callback():
                 'Authorization': f'Bearer {access_token}'
             }
             profile_url = "https://api.upstox.com/v2/user/profile"
-            profile_response = requests.get(profile_url, headers=headers)
+            profile_response = UPSTOX_HTTP.get(profile_url, headers=headers, timeout=UPSTOX_HTTP_TIMEOUT)
             profile_response.raise_for_status()
 
             upstox_profile = profile_response.json().get('data', {})
@@ -1002,7 +1330,7 @@ def fetch_historical_data():
             return jsonify({"success": False, "error": "Symbol is required"}), 400
 
         # Get Upstox client
-        upstox_api_client = upstox_service.get_configuration_api_client()
+        upstox_api_client = get_upstox_api_client()
         if not upstox_api_client:
             logger.error("Failed to get Upstox ApiClient for historical data.")
             return jsonify({"success": False, "error": "Upstox authentication failed"}), 401
@@ -1028,6 +1356,10 @@ def fetch_historical_data():
         logger.error(f"Error fetching historical data: {str(e)}")
         return jsonify({"success": False, "error": str(e)}), 500
 
+# Candle intervals available from each Upstox data source
+INTRADAY_INTERVALS = frozenset({"1minute", "3minute", "5minute", "15minute", "30minute", "1hour"})
+HISTORICAL_INTERVALS = INTRADAY_INTERVALS | frozenset({"1day", "1week", "1month"})
+
 @app.route('/api/merged-chart-data')
 @require_login
 def fetch_merged_chart_data():
@@ -1050,24 +1382,33 @@ def fetch_merged_chart_data():
             return jsonify({"success": False, "error": f"Could not find instrument details for {tradingsymbol}"}), 404
 
         # Get Upstox client
-        upstox_api_client = upstox_service.get_configuration_api_client()
+        upstox_api_client = get_upstox_api_client()
         if not upstox_api_client:
             logger.error("Failed to get Upstox ApiClient for chart data.")
             return jsonify({"success": False, "error": "Upstox authentication failed"}), 401
 
-        # Define available intervals for both data sources
-        intraday_intervals = ["1minute", "3minute", "5minute", "15minute", "30minute", "1hour"]
-        historical_intervals = ["1minute", "3minute", "5minute", "15minute", "30minute", "1hour", "1day", "1week", "1month"]
-
         # Determine if we can fetch data from each source based on the requested interval
-        fetch_intraday = interval in intraday_intervals  # Only fetch intraday for supported intervals
-        fetch_historical = interval in historical_intervals
+        fetch_intraday = interval in INTRADAY_INTERVALS  # Only fetch intraday for supported intervals
+        fetch_historical = interval in HISTORICAL_INTERVALS
 
         historical_data = None
         intraday_data = None
 
         logger.info(f"Fetching data for {tradingsymbol} (instrument_key: {instrument_key}) with interval {interval}")
 
+        def fetch_intraday_data():
+            return upstox_service.get_intra_day_candle_data(
+                instrument_key=instrument_key,
+                interval=interval,
+                exchange=exchange
+            )
+
+        # Both sources are independent Upstox calls, so when both are needed start the
+        # intraday request in the background while the historical one runs here
+        intraday_future = None
+        if fetch_historical and fetch_intraday:
+            intraday_future = upstox_request_executor.submit(fetch_intraday_data)
+
         # Step 1: Get historical data using the requested interval
         if fetch_historical:
             historical_data = upstox_service.get_historical_data(
@@ -1085,11 +1426,7 @@ def fetch_merged_chart_data():
 
         # Step 2: Get intraday data for recent updates (only for supported intervals)
         if fetch_intraday:
-            intraday_data = upstox_service.get_intra_day_candle_data(
-                instrument_key=instrument_key,
-                interval=interval,
-                exchange=exchange
-            )
+            intraday_data = intraday_future.result() if intraday_future else fetch_intraday_data()
 
             if intraday_data:
                 logger.info(f"Retrieved {len(intraday_data)} intraday candles with interval {interval}")
@@ -1131,6 +1468,38 @@ def fetch_merged_chart_data():
         logger.error(f"Error fetching merged chart data: {str(e)}", exc_info=True)
         return jsonify({"success": False, "error": str(e)}), 500
 
+def ltpc_emit_worker():
+    """
+    Background task that drains ltpc_emit_queue, coalesces everything that arrives within
+    LTPC_EMIT_WINDOW (latest value per instrument wins) and emits it as batched events.
+    """
+    while True:
+        coalesced = dict(ltpc_emit_queue.get())  # Block until the first update arrives
+        deadline = time.monotonic() + LTPC_EMIT_WINDOW
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                coalesced.update(ltpc_emit_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        try:
+            updates = [{'instrument_key': instrument_key, **data} for instrument_key, data in coalesced.items()]
+            for start in range(0, len(updates), LTPC_EMIT_BATCH_SIZE):
+                socketio.emit('ltpc_update_batch', updates[start:start + LTPC_EMIT_BATCH_SIZE])
+        except Exception as e:
+            logger.error(f"Error emitting LTPC updates: {e}", exc_info=True)
+
+def ensure_ltpc_emit_task():
+    """Start the LTPC emit background task once, on first use."""
+    global ltpc_emit_task
+    if ltpc_emit_task is None:
+        with ltpc_emit_task_lock:
+            if ltpc_emit_task is None:
+                ltpc_emit_task = socketio.start_background_task(ltpc_emit_worker)
+
 def on_upstox_market_data(feed_response):
     """
     Callback function for processing market data from Upstox WebSocket.
@@ -1139,24 +1508,35 @@ def on_upstox_market_data(feed_response):
     Args:
         feed_response: FeedResponse object from Upstox WebSocket
     """
-    global watchlist_ltpc_data
-
     # Use the extract_ltpc_from_feed function to get LTPC data
     ltpc_data = upstox_service.extract_ltpc_from_feed(feed_response)
 
     if ltpc_data:
-        # Update the global watchlist LTPC data
-        watchlist_ltpc_data.update(ltpc_data)
+        # Update the global watchlist LTPC store
+        update_watchlist_ltpc(ltpc_data)
 
-        # Emit the updated data to connected clients via Socket.IO
-        for instrument_key, data in ltpc_data.items():
-            data['instrument_key'] = instrument_key
-            socketio.emit('ltpc_update', data)
+        # Hand the data to the background emitter so the feed thread never blocks on Socket.IO
+        ensure_ltpc_emit_task()
+        try:
+            ltpc_emit_queue.put_nowait(ltpc_data)
+        except queue.Full:
+            logger.warning(f"LTPC emit queue full, dropping update for {len(ltpc_data)} instruments")
+            return
 
-        logger.info(f"Updated LTPC data for {len(ltpc_data)} instruments and broadcast to clients")
+        logger.debug("Updated LTPC data for %d instruments and queued for broadcast to clients", len(ltpc_data))
     else:
         logger.debug("No LTPC data extracted from market feed")
 
+@app.route('/api/watchlist/ltpc')
+@require_login
+def get_watchlist_ltpc():
+    """API endpoint to get the latest LTPC values for all instruments seen on the market feed"""
+    try:
+        return jsonify({"success": True, "ltpc": get_watchlist_ltpc_snapshot()})
+    except Exception as e:
+        logger.error(f"Error providing watchlist LTPC snapshot: {str(e)}")
+        return jsonify({"success": False, "error": str(e)}), 500
+
 @app.route('/api/upstox-auth-token')
 @require_login
 def get_upstox_auth_token():
@@ -1170,7 +1550,7 @@ def get_upstox_auth_token():
 
         # Check if the token has expired
         token_expiry = session.get('upstox_token_expiry')
-        if token_expiry and datetime.fromisoformat(token_expiry) <= datetime.now():
+        if token_expiry is not None and (not isinstance(token_expiry, int) or token_expiry <= time.time()):
             return jsonify({"success": False, "error": "Upstox token has expired, please re-authenticate"}), 401
 
         return jsonify({
@@ -1189,7 +1569,7 @@ def get_upstox_ws_auth_url():
     """API endpoint to get the authorized WebSocket URL for direct frontend connection"""
     try:
         # Get the API client with valid authentication
-        api_client = upstox_service.get_configuration_api_client()
+        api_client = get_upstox_api_client()
         if not api_client:
             logger.error("Failed to get Upstox ApiClient for WebSocket auth URL")
             return jsonify({"success": False, "error": "Upstox authentication failed"}), 401
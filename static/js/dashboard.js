@@ -875,7 +875,12 @@ document.addEventListener('DOMContentLoaded', function() {
     renderWatchlist();
 
     // --- Socket.IO LTPC (Last Traded Price & Change) live updates ---
-    socket.on('ltpc_update', function(data) {
+    // The server batches all instruments from a feed message into one array per event
+    socket.on('ltpc_update_batch', function(updates) {
+        updates.forEach(applyLtpcUpdate);
+    });
+
+    function applyLtpcUpdate(data) {
         // Skip if we don't have the instrument in our watchlist
         if (!data.instrument_key || !watchlist[data.instrument_key]) {
             return;
@@ -946,7 +951,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 <span class="text-sm ml-2 ${colorClass}">${changeText} (${pctText})</span>
             `;
         }
-    });
+    }
 });
 
 
@@ -6,10 +6,12 @@ from upstox_client.rest import ApiException
 from upstox_client.configuration import Configuration
 
 import json
+import orjson
 import logging
 import os
 import time
 from datetime import datetime, timedelta
+from collections import OrderedDict
 from dotenv import load_dotenv
 
 # Add CSV handling imports
@@ -26,6 +28,7 @@ logger = logging.getLogger(__name__)
 import asyncio
 import websockets
 import threading # Added for threading.Event
+import queue # For incremental subscriptions to a running WebSocket
 
 # Attempt to import the generated Protobuf file
 # This file should be generated by you using protoc (see instructions)
@@ -56,9 +59,17 @@ NSE_CSV_URL = "https://assets.upstox.com/market-quote/instruments/exchange/NSE.c
 NSE_CSV_LOCAL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "instrument_cache", "nse_instruments.csv")
 NSE_CSV_PROCESSED_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "instrument_cache", "nse_instruments_processed.json")
 
+# Access token persistence, populated by the redirect callback
+UPSTOX_TOKEN_FILE = os.path.join(os.getcwd(), 'upstox_token.json')
+TOKEN_FILE_MISS_TTL = 1.0  # seconds a missing token file is remembered before checking again
+
 # Global token storage
 _access_token = None
-_token_expiry = None
+_token_expiry = None  # Epoch seconds, stored the same way in the token file's expires_at
+_token_file_mtime = None  # mtime of the token file when it was last parsed
+_token_file_unreadable = False  # Whether the file at _token_file_mtime failed to parse
+_token_file_missing_until = 0.0  # Epoch seconds until which a missing token file isn't looked up again
+_token_lock = threading.Lock()  # Serializes token file loads and saves across request/worker threads
 
 # Global cache for instruments
 _instruments_cache = {
@@ -68,6 +79,13 @@ _instruments_cache = {
     "last_updated": None
 }
 
+# LRU cache of historical candle responses keyed on (instrument_key, interval, to_date).
+# Repeated chart loads for the same instrument reuse the candles instead of refetching them.
+HISTORICAL_CACHE_MAX_ENTRIES = 256
+HISTORICAL_CACHE_TTL = 300  # seconds, bounds staleness of the most recent candle
+_historical_data_cache = OrderedDict()  # key -> (fetched_at, candles)
+_historical_data_cache_lock = threading.Lock()
+
 def refresh_and_filter_nse_instruments():
     """
     Downloads, filters (for NSE_EQ), and saves NSE instruments to the cache file.
@@ -136,30 +154,64 @@ def get_access_token():
     Note: Upstox requires OAuth authorization flow with user interaction.
     This function should be used after obtaining an authorization code through the redirect callback.
     """
-    global _access_token, _token_expiry
+    global _access_token, _token_expiry, _token_file_mtime, _token_file_unreadable, _token_file_missing_until
 
-    # If token exists and not expired, return it
-    if _access_token and _token_expiry and datetime.now() < _token_expiry:
-        return _access_token
+    now = time.time()
 
-    # Try to read token from a file - which should be populated by the redirect callback
-    token_file = os.path.join(os.getcwd(), 'upstox_token.json')
+    # If token exists and not expired, return it (lock-free fast path)
+    if _access_token and _token_expiry and now < _token_expiry:
+        return _access_token
 
-    if os.path.exists(token_file):
-        try:
-            with open(token_file, 'r') as f:
-                stored_data = json.load(f)
+    with _token_lock:
+        # Another thread may have loaded or saved the token while this one waited for the lock
+        if _access_token and _token_expiry and now < _token_expiry:
+            return _access_token
 
-            # Check if token is still valid
-            if stored_data.get('expires_at') and datetime.fromisoformat(stored_data['expires_at']) > datetime.now():
-                _access_token = stored_data['access_token']
-                _token_expiry = datetime.fromisoformat(stored_data['expires_at'])
-                logger.info(f"Loaded valid Upstox access token from file, expires at {_token_expiry}")
-                return _access_token
-            else:
-                logger.warning("Stored Upstox token has expired")
-        except Exception as e:
-            logger.error(f"Error reading Upstox token file: {e}")
+        # Try to read token from the token file, unless it was just found missing
+        if now >= _token_file_missing_until:
+            try:
+                token_file_mtime = os.stat(UPSTOX_TOKEN_FILE).st_mtime
+                if token_file_mtime == _token_file_mtime:
+                    # The file hasn't changed since it was last parsed; an unreadable file was
+                    # already reported then, otherwise its token is the expired one above
+                    if not _token_file_unreadable:
+                        logger.warning("Stored Upstox token has expired")
+                else:
+                    _token_file_mtime = token_file_mtime
+                    _token_file_unreadable = False
+                    try:
+                        with open(UPSTOX_TOKEN_FILE, 'rb') as f:
+                            stored_data = orjson.loads(f.read())
+
+                        token_expiry = stored_data.get('expires_at')
+                        legacy_expiry = isinstance(token_expiry, str)
+                        if legacy_expiry:
+                            # Token files written before expiries were stored as epoch seconds
+                            token_expiry = int(datetime.fromisoformat(token_expiry).timestamp())
+                        access_token = stored_data['access_token']
+                    except FileNotFoundError:
+                        raise
+                    except Exception as e:
+                        # Remember the bad file so it isn't re-parsed (and re-logged) until it changes
+                        _token_file_unreadable = True
+                        logger.error("Upstox token file is unreadable, log in again to replace it: %s", e)
+                    else:
+                        # Check if token is still valid
+                        if token_expiry and token_expiry > now:
+                            _access_token = access_token
+                            _token_expiry = token_expiry
+                            logger.info("Loaded valid Upstox access token from file, expires at %d", token_expiry)
+                            if legacy_expiry:
+                                _write_token_file(_access_token, token_expiry)
+                            return _access_token
+                        else:
+                            logger.warning("Stored Upstox token has expired")
+            except FileNotFoundError:
+                # No token has been saved yet; remember that briefly so a burst of
+                # unauthenticated requests doesn't stat the file on every call
+                _token_file_missing_until = now + TOKEN_FILE_MISS_TTL
+            except Exception as e:
+                logger.error("Error reading Upstox token file: %s", e)
 
     # If we get here, we need a new token, but this requires user interaction
     logger.error("Upstox authentication requires user interaction. Please use the login flow.")
@@ -173,22 +225,36 @@ def save_access_token(access_token, expires_in=86400):
         access_token (str): The access token to save
         expires_in (int): Expiry time in seconds from now
     """
-    global _access_token, _token_expiry
+    global _access_token, _token_expiry, _token_file_missing_until
 
-    _access_token = access_token
-    _token_expiry = datetime.now() + timedelta(seconds=expires_in - 300)  # 5 minutes buffer
+    token_expiry = int(time.time() + expires_in) - 300  # 5 minutes buffer
 
-    token_file = os.path.join(os.getcwd(), 'upstox_token.json')
+    with _token_lock:
+        _access_token = access_token
+        _token_expiry = token_expiry
+        _token_file_missing_until = 0.0
+        _write_token_file(access_token, token_expiry)
 
+def _write_token_file(access_token, token_expiry):
+    """
+    Atomically write the access token and its expiry (epoch seconds) to the token file.
+    Callers must hold _token_lock.
+    """
     try:
-        with open(token_file, 'w') as f:
-            json.dump({
+        # Write a temporary file and move it into place so a crash mid-write
+        # never leaves a truncated token file behind
+        tmp_token_file = UPSTOX_TOKEN_FILE + '.tmp'
+        with open(tmp_token_file, 'wb') as f:
+            f.write(orjson.dumps({
                 'access_token': access_token,
-                'expires_at': _token_expiry.isoformat()
-            }, f)
-        logger.info(f"Saved Upstox access token to file, expires at {_token_expiry}")
+                'expires_at': token_expiry
+            }))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_token_file, UPSTOX_TOKEN_FILE)
+        logger.info("Saved Upstox access token to file, expires at %d", token_expiry)
     except Exception as e:
-        logger.error(f"Error saving Upstox token to file: {e}")
+        logger.error("Error saving Upstox token to file: %s", e)
 
 def get_auth_token_from_code(auth_code):
     """
@@ -346,13 +412,62 @@ def get_market_data_feed_authorize_url(api_client_instance):
         logger.error(f"Error getting market data feed authorize URL: {e}")
         return None
 
-async def connect_and_stream_market_data(feed_url, instrument_keys, on_message_callback, shutdown_threading_event: threading.Event): # Modified signature
+def build_subscription_request(instrument_keys, method="sub"):
+    """
+    Build a market data feed subscription message for the given instrument keys.
+
+    Args:
+        instrument_keys (list): Instrument keys like "NSE_EQ|INE002A01018"
+        method (str): Feed method, e.g. "sub" or "unsub"
+
+    Returns:
+        dict: Message to be JSON-encoded and sent over the WebSocket
+    """
+    return {
+        "guid": "pyalgo-guid-" + str(time.time()),
+        "method": method,
+        "data": {
+            "instrumentKeys": instrument_keys
+        }
+    }
+
+def drain_subscription_queue(subscription_queue, pending_keys):
+    """
+    Move every instrument key list waiting on subscription_queue into pending_keys.
+
+    Args:
+        subscription_queue (queue.Queue): Queue of instrument key lists, or None
+        pending_keys (list): List the drained keys are appended to
+
+    Returns:
+        list: pending_keys
+    """
+    if subscription_queue is not None:
+        while True:
+            try:
+                pending_keys.extend(subscription_queue.get_nowait())
+            except queue.Empty:
+                break
+    return pending_keys
+
+async def connect_and_stream_market_data(feed_url, instrument_keys, on_message_callback, shutdown_threading_event: threading.Event, subscription_queue: queue.Queue = None,
+                                         on_subscribed_callback=None, on_close_callback=None): # Modified signature
     """
     Connects to the Upstox market data WebSocket and streams data.
     Gracefully shuts down if shutdown_threading_event is set.
+    Lists of instrument keys put on subscription_queue are subscribed on the open
+    connection without reconnecting.
+
+    on_subscribed_callback(keys) is called once a subscription request for keys has been sent.
+    on_close_callback(unsent_keys) is called when the function exits, with any queued keys
+    that were never sent so the caller can subscribe them on a new connection.
     """
+    pending_keys = []  # Queued keys not yet sent on the connection
+
     if not MarketDataFeed_pb2:
         logger.error("MarketDataFeed_pb2 module not loaded. Cannot stream market data.")
+        if on_close_callback:
+            on_close_callback(drain_subscription_queue(subscription_queue, pending_keys))
         return
 
     try:
@@ -361,18 +476,23 @@ async def connect_and_stream_market_data(feed_url, instrument_keys, on_message_c
         async with websockets.connect(feed_url, ping_interval=30, ping_timeout=10, open_timeout=20) as websocket:
             logger.info(f"Successfully connected to Upstox Market Data WebSocket: {feed_url}")
 
-            sub_request = {
-                "guid": "pyalgo-guid-" + str(time.time()),
-                "method": "sub",
-                "data": {
-                    "instrumentKeys": instrument_keys
-                }
-            }
+            sub_request = build_subscription_request(instrument_keys)
             await websocket.send(json.dumps(sub_request))
             logger.info(f"Sent subscription request for instruments: {instrument_keys}")
+            if on_subscribed_callback:
+                on_subscribed_callback(instrument_keys)
 
             while not shutdown_threading_event.is_set():
                 try:
+                    # Send any subscriptions added since the last message as a single "sub" request
+                    drain_subscription_queue(subscription_queue, pending_keys)
+                    if pending_keys:
+                        await websocket.send(json.dumps(build_subscription_request(pending_keys)))
+                        logger.info(f"Sent incremental subscription request for instruments: {pending_keys}")
+                        if on_subscribed_callback:
+                            on_subscribed_callback(pending_keys)
+                        pending_keys = []
+
                     # Wait for a message with a timeout, so we can check the shutdown event
                     message = await asyncio.wait_for(websocket.recv(), timeout=1.0)
                     feed_response = MarketDataFeed_pb2.FeedResponse()
@@ -412,6 +532,9 @@ async def connect_and_stream_market_data(feed_url, instrument_keys, on_message_c
         logger.error(f"An unexpected error occurred in WebSocket connection/streaming for {feed_url}: {e}", exc_info=True)
     finally:
         logger.info(f"WebSocket function connect_and_stream_market_data for {feed_url} is concluding.")
+        if on_close_callback:
+            # Hand back everything that was queued but never sent
+            on_close_callback(drain_subscription_queue(subscription_queue, pending_keys))
 
 
 def get_historical_data(instrument_key, interval="1day", from_date=None, to_date=None, exchange="NSE_EQ"):
@@ -464,6 +587,16 @@ def get_historical_data(instrument_key, interval="1day", from_date=None, to_date
             to_date = datetime.now().strftime("%Y-%m-%d")
         if not from_date:
             from_date = (datetime.now() - timedelta(days=60)).strftime("%Y-%m-%d")
+
+        # from_date is not sent to the API, so it isn't part of the cache key
+        cache_key = (instrument_key, interval, to_date)
+        with _historical_data_cache_lock:
+            cached = _historical_data_cache.get(cache_key)
+            if cached and time.time() - cached[0] < HISTORICAL_CACHE_TTL:
+                _historical_data_cache.move_to_end(cache_key)
+                logger.info(f"Using cached historical data for {instrument_key} ({len(cached[1])} candles)")
+                return cached[1]
+
         # API call to fetch historical data
         response = history_api.get_historical_candle_data(
             instrument_key=instrument_key,
@@ -476,6 +609,11 @@ def get_historical_data(instrument_key, interval="1day", from_date=None, to_date
         # Process the response data
         if response and hasattr(response, 'data') and hasattr(response.data, 'candles'):
             logger.info(f"Successfully retrieved historical data for {instrument_key}, got {len(response.data.candles)} candles")
+            with _historical_data_cache_lock:
+                _historical_data_cache[cache_key] = (time.time(), response.data.candles)
+                _historical_data_cache.move_to_end(cache_key)
+                if len(_historical_data_cache) > HISTORICAL_CACHE_MAX_ENTRIES:
+                    _historical_data_cache.popitem(last=False)
             return response.data.candles
         else:
             logger.warning(f"No candle data in response for {instrument_key}")
@@ -926,23 +1064,13 @@ def get_intra_day_candle_data(instrument_key, interval="5minute", exchange="NSE_
             candles_data = response.data.candles
             logger.info(f"Successfully retrieved intraday candle data for {instrument_key}, got {len(candles_data)} candles")
 
-            # Process and format the candle data to match the expected format
-            formatted_candles = []
-            for candle in candles_data:
-                # Each candle should be a list with [timestamp, open, high, low, close, volume, oi]
-                # The timestamp format should be "YYYY-MM-DDThh:mm:ss+05:30"
-                formatted_candle = [
-                    candle[0],           # timestamp
-                    float(candle[1]),    # open
-                    float(candle[2]),    # high
-                    float(candle[3]),    # low
-                    float(candle[4]),    # close
-                    int(candle[5]),      # volume
-                    0                    # oi (open interest) - defaulting to 0 if not available
-                ]
-                formatted_candles.append(formatted_candle)
-
-            return formatted_candles
+            # Process and format the candle data to match the expected format:
+            # [timestamp, open, high, low, close, volume, oi] with the timestamp as
+            # "YYYY-MM-DDThh:mm:ss+05:30" and oi (open interest) defaulting to 0
+            return [
+                [timestamp, float(open_), float(high), float(low), float(close), int(volume), 0]
+                for timestamp, open_, high, low, close, volume, *_ in candles_data
+            ]
         else:
             logger.warning(f"No intraday candle data in response for {instrument_key}")
             return None
@@ -974,18 +1102,24 @@ def extract_ltpc_from_feed(feed_response):
         for instrument_key, feed_data in feed_response.feeds.items():
             if feed_data.ff.marketFF.ltpc:
                 ltpc = feed_data.ff.marketFF.ltpc
+                # The LTPC message only carries ltp/ltt/ltq/cp, so derive the change from the close
+                if ltpc.ltp and ltpc.cp:
+                    change = ltpc.ltp - ltpc.cp
+                    percentage_change = change / ltpc.cp * 100
+                else:
+                    change = 0
+                    percentage_change = 0
                 ltpc_data[instrument_key] = {
                     "ltp": ltpc.ltp,                     # Last traded price
-                    "change": ltpc.ch,                   # Change from previous close
-                    "percentage_change": ltpc.chp,       # Change percentage
+                    "change": change,                    # Change from previous close
+                    "percentage_change": percentage_change,  # Change percentage
                     "close_price": ltpc.cp,              # Close price (previous day)
                     "last_trade_time": ltpc.ltt,         # Last trade time (timestamp)
                     "volume": ltpc.v if hasattr(ltpc, 'v') else None,  # Volume (if available)
                     "atp": ltpc.atp if hasattr(ltpc, 'atp') else None  # Average traded price (if available)
                 }
 
-        if ltpc_data:
-            logger.info(f"Extracted LTPC data for {len(ltpc_data)} instruments from market data feed")
+        logger.debug("Extracted LTPC data for %d instruments from market data feed", len(ltpc_data))
         return ltpc_data
 
     except Exception as e: